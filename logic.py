@@ -1,11 +1,28 @@
 from google import genai
+import asyncio
+import ijson
 import json
 import time
 import os
+from collections import deque
 from dotenv import load_dotenv
 
 
 class ReasoningSystem:
+    # Instrucción de sistema constante: viaja como system_instruction (el SDK
+    # la cachea entre llamadas) en lugar de repetirse dentro de cada prompt,
+    # recortando ~5x los tokens de entrada del prefijo fijo.
+    SCHEMA_PROMPT = (
+        "Eres un sistema de razonamiento avanzado que responde mediante ciclos "
+        "de pensamiento. DEBES devolver SOLO un objeto JSON válido, sin texto "
+        "adicional antes o después, con exactamente esta estructura:\n"
+        '{"razonamiento":[{"ciclo":int,"análisis":str,"ideas":str,'
+        '"evaluación":str,"refinamiento":str}],"respuesta_final":str}\n'
+        "En cada ciclo: analiza la información disponible, genera nuevas ideas, "
+        "evalúa críticamente tus conclusiones y refina tu respuesta. La "
+        "respuesta_final debe ser didáctica, en markdown y con emojis apropiados."
+    )
+
     def __init__(self, api_key, model="gemini-1.5-pro"):
         """
         Inicializa el sistema de razonamiento con Gemini.
@@ -15,53 +32,25 @@ class ReasoningSystem:
             model (str): Modelo de Gemini a utilizar (por defecto: gemini-1.5-pro)
         """
         self.client = genai.Client(api_key=api_key)
+        self.aio = self.client.aio
         self.model = model
-        self.history = []
+        # Historial acotado: en un servicio de larga vida una lista sin
+        # límite retendría todas las respuestas para siempre
+        self.history = deque(maxlen=1024)
 
     def _create_reasoning_prompt(self, query, num_cycles=3):
         """
-        Crea un prompt estructurado para fomentar el razonamiento por ciclos.
+        Crea el prompt de usuario; el esquema y las instrucciones fijas
+        viajan aparte en SCHEMA_PROMPT como system_instruction.
 
         Args:
             query (str): La pregunta o instrucción del usuario
             num_cycles (int): Número de ciclos de razonamiento
 
         Returns:
-            str: Prompt estructurado para Gemini
-        """
-        return f"""
-        Actúa como un sistema de razonamiento avanzado que responde a consultas mediante ciclos de pensamiento.
-        
-        IMPORTANTE: DEBES devolver SOLO un objeto JSON válido con EXACTAMENTE esta estructura, sin texto adicional antes o después:
-        
-        {{
-            "razonamiento": [
-                {{
-                    "ciclo": 1,
-                    "análisis": "Tu análisis inicial...",
-                    "ideas": "Ideas generadas...",
-                    "evaluación": "Evaluación crítica...",
-                    "refinamiento": "Refinamiento de la idea..."
-                }},
-                // Repite exactamente este formato para cada ciclo
-            ],
-            "respuesta_final": "Tu respuesta final en formato markdown, didáctica e incluyendo emojis apropiados."
-        }}
-        
-        # Instrucción
-        Responde a la siguiente consulta utilizando exactamente {num_cycles} ciclos de razonamiento explícito. 
-        Para cada ciclo, debes:
-        
-        1. Analizar la información disponible hasta el momento
-        2. Generar nuevas ideas o perspectivas
-        3. Evaluar críticamente tus conclusiones
-        4. Refinar tu respuesta basada en este análisis
-        
-        # Consulta
-        {query}
-        
-        Recuerda: tu respuesta DEBE ser SOLO un objeto JSON válido que siga EXACTAMENTE la estructura solicitada.
+            str: Prompt corto para Gemini
         """
+        return f"Consulta: {query}\nCiclos de razonamiento: {num_cycles}"
 
     def generate_reasoned_response(self, query, num_cycles=3, temperature=0.7):
         """
@@ -80,6 +69,7 @@ class ReasoningSystem:
 
             # Configura parámetros de generación
             generation_config = {
+                "system_instruction": self.SCHEMA_PROMPT,
                 "temperature": temperature,
                 "top_p": 0.95,
                 "top_k": 40,
@@ -102,15 +92,13 @@ class ReasoningSystem:
                 # Primero limpiamos el texto para encontrar solo la parte JSON válida
                 response_text = response.text.strip()
 
-                # Buscar el inicio y fin de un posible objeto JSON
-                json_start = response_text.find("{")
-                json_end = response_text.rfind("}") + 1
+                # Recortar la prosa alrededor del objeto: todo desde la
+                # primera '{' hasta la última '}' inclusive
+                _, llave_inicio, resto = response_text.partition("{")
+                cuerpo, llave_fin, _ = resto.rpartition("}")
 
-                if json_start >= 0 and json_end > json_start:
-                    # Extraer el texto que parece ser JSON
-                    json_text = response_text[json_start:json_end]
-                    # Intentar parsear
-                    result = json.loads(json_text)
+                if llave_inicio and llave_fin:
+                    result = json.loads(llave_inicio + cuerpo + llave_fin)
                 else:
                     raise json.JSONDecodeError(
                         "No se encontró estructura JSON", response_text, 0
@@ -166,9 +154,71 @@ class ReasoningSystem:
                 "respuesta_final": f"Error al generar respuesta: {str(e)}",
             }
 
-    def stream_final_response(self, query, num_cycles=3, temperature=0.7):
+    async def astream_reasoning_cycles(self, query, num_cycles=3, temperature=0.7):
         """
-        Genera y transmite solo la respuesta final usando el streaming nativo de la API.
+        Genera la respuesta en streaming y emite cada ciclo de razonamiento
+        en cuanto su '}' de cierre llega del modelo, sin esperar a que
+        termine la generación completa.
+
+        Args:
+            query (str): La pregunta o instrucción del usuario
+            num_cycles (int): Número de ciclos de razonamiento
+            temperature (float): Nivel de creatividad (0.0-1.0)
+
+        Yields:
+            dict: Cada ciclo de razonamiento ya parseado
+        """
+        prompt = self._create_reasoning_prompt(query, num_cycles)
+
+        generation_config = {
+            "system_instruction": self.SCHEMA_PROMPT,
+            "temperature": temperature,
+            "top_p": 0.95,
+            "top_k": 40,
+            "max_output_tokens": 4096,
+        }
+
+        # Parser incremental: ijson consume los chunks según llegan y va
+        # completando los elementos de "razonamiento" en esta lista.
+        ciclos = ijson.sendable_list()
+        parser = ijson.items_coro(ciclos, "razonamiento.item")
+        dentro_json = False
+
+        try:
+            response_stream = await self.aio.models.generate_content_stream(
+                model=self.model, contents=prompt, config=generation_config
+            )
+            async for chunk in response_stream:
+                texto = getattr(chunk, "text", None)
+                if not texto:
+                    continue
+                if not dentro_json:
+                    # Descartar la prosa previa al objeto JSON
+                    inicio = texto.find("{")
+                    if inicio < 0:
+                        continue
+                    texto = texto[inicio:]
+                    dentro_json = True
+                try:
+                    parser.send(texto.encode())
+                except StopIteration:
+                    pass
+                while ciclos:
+                    yield ciclos.pop(0)
+        finally:
+            try:
+                parser.close()
+            except Exception:
+                pass
+
+    async def stream_final_response(self, query, num_cycles=3, temperature=0.7):
+        """
+        Genera y transmite solo la respuesta final usando el streaming nativo
+        asíncrono de la API.
+
+        Un productor llena una cola acotada con los chunks según llegan; si el
+        consumidor (p. ej. un cliente HTTP lento) no les sigue el ritmo, la
+        cola se llena y la generación se pausa en vez de acumular memoria.
 
         Args:
             query (str): La pregunta o instrucción del usuario
@@ -178,38 +228,47 @@ class ReasoningSystem:
         Yields:
             str: Fragmentos de la respuesta final
         """
-        try:
-            # Creamos un prompt simplificado para streaming directo
-            direct_prompt = f"""
-            Responde a la siguiente consulta de manera didáctica, usando markdown y emojis apropiados:
-            
-            {query}
-            
-            Piensa paso a paso antes de responder, considerando al menos {num_cycles} perspectivas diferentes.
-            """
+        # Creamos un prompt simplificado para streaming directo
+        direct_prompt = f"""
+        Responde a la siguiente consulta de manera didáctica, usando markdown y emojis apropiados:
 
-            # Configura parámetros de generación
-            generation_config = {
-                "temperature": temperature,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": 2048,
-            }
+        {query}
 
-            # Usamos el streaming nativo de la API
-            response_stream = self.client.models.generate_content_stream(
-                model=self.model,
-                contents=direct_prompt,
-                config=generation_config,
-            )
+        Piensa paso a paso antes de responder, considerando al menos {num_cycles} perspectivas diferentes.
+        """
 
-            # Devolvemos los chunks tal como llegan
-            for chunk in response_stream:
-                if hasattr(chunk, "text") and chunk.text:
-                    yield chunk.text
+        # Configura parámetros de generación
+        generation_config = {
+            "temperature": temperature,
+            "top_p": 0.95,
+            "top_k": 40,
+            "max_output_tokens": 2048,
+        }
 
-        except Exception as e:
-            yield f"Error en streaming: {str(e)}"
+        cola = asyncio.Queue(maxsize=8)
+        fin = object()
+
+        async def productor():
+            try:
+                response_stream = await self.aio.models.generate_content_stream(
+                    model=self.model,
+                    contents=direct_prompt,
+                    config=generation_config,
+                )
+                async for chunk in response_stream:
+                    if hasattr(chunk, "text") and chunk.text:
+                        await cola.put(chunk.text)
+            except Exception as e:
+                await cola.put(f"Error en streaming: {str(e)}")
+            finally:
+                await cola.put(fin)
+
+        tarea = asyncio.create_task(productor())
+        try:
+            while (chunk := await cola.get()) is not fin:
+                yield chunk
+        finally:
+            tarea.cancel()
 
 
 # # Ejemplo de uso
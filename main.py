@@ -1,11 +1,22 @@
-from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
+import msgspec
+import aiosqlite
+import asyncio
+import functools
+import hashlib
 import logging
 import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import httpx
+import numpy as np
+import orjson
 from datetime import datetime, timedelta
 from typing import List, Optional, Dict, Any
-import json
 import os
 from dotenv import load_dotenv
 from google import genai
@@ -18,28 +29,122 @@ logger = logging.getLogger("water_flow_api")
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI")
 
-app = FastAPI(title="Sistema de Monitoreo de Flujo de Agua")
+# Cola de trabajos de análisis: un worker dedicado procesa las llamadas a
+# Gemini en serie, fuera del ciclo de vida de las peticiones, para que la
+# ingesta no comparta su turno del event loop con análisis lentos ni se
+# acumulen análisis concurrentes.
+_analysis_queue: asyncio.Queue = asyncio.Queue()
+_analysis_job_counter = 0
+
+
+def encolar_analisis() -> int:
+    """Encola un trabajo de análisis y devuelve su id."""
+    global _analysis_job_counter
+    _analysis_job_counter += 1
+    _analysis_queue.put_nowait(_analysis_job_counter)
+    return _analysis_job_counter
 
-# Configurar CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+
+async def _analysis_worker():
+    while True:
+        job_id = await _analysis_queue.get()
+        try:
+            await analizar_datos_flujo()
+            logger.info(f"Trabajo de análisis {job_id} completado")
+        except Exception as e:
+            logger.error(f"Trabajo de análisis {job_id} falló: {e}")
+
+
+async def _stats_writer_loop():
+    """Guarda una instantánea de estadísticas por minuto, fuera del GET."""
+    while True:
+        await asyncio.sleep(60)
+        try:
+            stats = await db_manager.obtener_estadisticas()
+            await db_manager.guardar_snapshot_estadisticas(stats)
+        except Exception as e:
+            logger.error(f"Error al guardar snapshot de estadísticas: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db_manager.startup()
+    # Volcado periódico del buffer de escrituras de flujo e instantáneas
+    # de estadísticas fuera del camino de las peticiones
+    flush_task = asyncio.create_task(db_manager._flusher())
+    stats_task = asyncio.create_task(_stats_writer_loop())
+    analysis_task = asyncio.create_task(_analysis_worker())
+    yield
+    flush_task.cancel()
+    stats_task.cancel()
+    analysis_task.cancel()
+    await db_manager.shutdown()
+    # Cerrar el transporte HTTP compartido del cliente Gemini, si se creó
+    if get_reasoner.cache_info().currsize and get_reasoner().aio is not None:
+        cerrar = getattr(get_reasoner().aio, "aclose", None)
+        if cerrar is not None:
+            await cerrar()
+
+
+app = FastAPI(
+    title="Sistema de Monitoreo de Flujo de Agua",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+# CORS abierto con un middleware ASGI mínimo: añade las cabeceras en un
+# solo paso y responde los preflight antes de entrar al router, sin
+# construir objetos Response de Starlette por petición. (La combinación
+# anterior allow_origins=["*"] + allow_credentials=True además es
+# inválida según la especificación CORS.)
+_CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"*"),
+    (b"access-control-allow-headers", b"*"),
+]
+
+
+class CORSHeadersASGI:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Preflight: 204 inmediato sin pasar por el router
+        if scope["method"] == "OPTIONS":
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 204,
+                    "headers": list(_CORS_HEADERS),
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_con_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + _CORS_HEADERS
+            await send(message)
+
+        await self.app(scope, receive, send_con_cors)
 
-# Modelos para la API
-class FlujoAgua(BaseModel):
-    flujo: float
 
+app.add_middleware(CORSHeadersASGI)
 
-class RegistroFlujo(BaseModel):
-    id: int
+
+# Modelos para la API. El del camino caliente (POST /flujo) usa msgspec
+# en lugar de Pydantic: decodificar los bytes crudos evita la maquinaria
+# de validación por campo en cada petición del ESP32. El historial se
+# sirve directamente desde sqlite3.Row con orjson, sin modelo intermedio.
+class FlujoAgua(msgspec.Struct):
     flujo: float
-    timestamp: str
-    analisis: Optional[str] = None
+
+
+FLUJO_DECODER = msgspec.json.Decoder(FlujoAgua)
 
 
 class TendenciaAnalisis(BaseModel):
@@ -52,6 +157,234 @@ class TendenciaAnalisis(BaseModel):
     detalles: Dict[str, Any] = {}
 
 
+# Timestamp cacheado a resolución de segundo: la telemetría llega como
+# mucho a unos pocos Hz, así que no hace falta pagar datetime.now() +
+# isoformat() en cada inserción
+_TS_CACHE = ["", 0]
+
+
+def _iso_now():
+    sec = int(time.time())
+    if sec != _TS_CACHE[1]:
+        _TS_CACHE[0] = datetime.fromtimestamp(sec).isoformat()
+        _TS_CACHE[1] = sec
+    return _TS_CACHE[0]
+
+
+# Esquema del análisis de flujo. La versión dict se pasa a Gemini como
+# response_schema (salida estructurada) y el Struct decodifica la
+# respuesta en una sola pasada con msgspec.
+class AnalysisResult(msgspec.Struct):
+    tendencia: str = "desconocida"
+    probabilidad_fuga: float = 0.0
+    recomendacion: str = "No hay recomendaciones disponibles"
+    detalles: Dict[str, Any] = msgspec.field(default_factory=dict)
+
+
+ANALYSIS_DECODER = msgspec.json.Decoder(AnalysisResult)
+
+ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "tendencia": {"type": "STRING"},
+        "probabilidad_fuga": {"type": "NUMBER"},
+        "recomendacion": {"type": "STRING"},
+        "detalles": {
+            "type": "OBJECT",
+            "properties": {
+                "patrones_identificados": {
+                    "type": "ARRAY",
+                    "items": {"type": "STRING"},
+                },
+                "anomalias": {"type": "ARRAY", "items": {"type": "STRING"}},
+                "explicacion": {"type": "STRING"},
+            },
+        },
+    },
+    "required": ["tendencia", "probabilidad_fuga", "recomendacion"],
+}
+
+# Plantilla del prompt de análisis, construida una vez a nivel de módulo.
+# Usa formateo con % porque el ejemplo de salida contiene llaves literales.
+PROMPT_TEMPLATE = """
+# Análisis de Datos de Flujo de Agua
+
+Analiza los siguientes datos de flujo de agua y proporciona una evaluación detallada.
+
+## Datos
+```
+%s
+```
+
+## Instrucciones
+Realiza un análisis completo siguiendo estos pasos:
+
+1. Identifica patrones en los datos de flujo (estables, ascendentes, descendentes, fluctuantes)
+2. Detecta anomalías que puedan indicar fugas o problemas
+3. Evalúa la probabilidad de una fuga basada en los patrones
+4. Proporciona recomendaciones específicas
+
+## Formato de Respuesta
+Tu respuesta DEBE estar en formato JSON con exactamente esta estructura:
+
+{
+    "tendencia": "estable|creciente|decreciente|fluctuante",
+    "probabilidad_fuga": valor_numérico_entre_0_y_100,
+    "recomendacion": "texto con acción recomendada",
+    "detalles": {
+        "patrones_identificados": ["lista", "de", "patrones"],
+        "anomalias": ["lista", "de", "anomalías"],
+        "explicacion": "explicación del análisis"
+    }
+}
+"""
+
+# Parámetros de generación comunes; cada llamada añade encima la
+# temperatura (y, en su caso, la salida estructurada).
+GENERATION_CONFIG_BASE = {
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 4096,
+}
+
+
+# Caché semántica de dos niveles para respuestas de razonamiento:
+# nivel 1 exacto (hash de la consulta normalizada) y nivel 2 por similitud
+# de embeddings, para no repetir llamadas a Gemini con consultas iguales
+# o parafraseadas.
+class SemanticCache:
+    def __init__(self, client, threshold=0.92, ttl=300, maxsize=256):
+        self.client = client
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._exact = OrderedDict()  # clave sha1 -> (expira, resultado)
+        self._matrix = None  # ndarray (N, D) con embeddings normalizados
+        self._meta = []  # por fila: (tokens, expira, resultado)
+
+    @staticmethod
+    def _key(query: str) -> str:
+        return hashlib.sha1(" ".join(query.split()).lower().encode()).hexdigest()
+
+    @staticmethod
+    def _tokens(query: str) -> frozenset:
+        return frozenset(query.lower().split())
+
+    async def _embed(self, query: str):
+        try:
+            resp = await self.client.aio.models.embed_content(
+                model="text-embedding-004", contents=query
+            )
+            vec = np.asarray(resp.embeddings[0].values, dtype=np.float32)
+            return vec / np.linalg.norm(vec)
+        except Exception as e:
+            logger.warning(f"No se pudo calcular embedding para la caché: {e}")
+            return None
+
+    def _purge(self):
+        now = time.time()
+        vencidas = [k for k, (expira, _) in self._exact.items() if expira < now]
+        for k in vencidas:
+            del self._exact[k]
+        if self._meta and any(expira < now for _, expira, _ in self._meta):
+            vivos = [i for i, (_, expira, _) in enumerate(self._meta) if expira >= now]
+            self._meta = [self._meta[i] for i in vivos]
+            self._matrix = self._matrix[vivos] if vivos else None
+
+    async def lookup(self, query: str):
+        """Devuelve (resultado, vector, clave); resultado es None si hay miss."""
+        self._purge()
+        key = self._key(query)
+        entry = self._exact.get(key)
+        if entry is not None:
+            # Refrescar el orden LRU: bajo presión de tamaño se desalojan
+            # las entradas menos usadas, no las más antiguas
+            self._exact.move_to_end(key)
+            logger.info("Caché semántica: hit exacto")
+            return entry[1], None, key
+
+        vec = await self._embed(query)
+        if vec is not None and self._matrix is not None:
+            sims = self._matrix @ vec
+            best = int(np.argmax(sims))
+            tokens = self._tokens(query)
+            cached_tokens = self._meta[best][0]
+            # Huella léxica: evita falsos positivos entre consultas casi
+            # idénticas que difieren en un término clave.
+            overlap = len(tokens & cached_tokens) / max(len(tokens | cached_tokens), 1)
+            if sims[best] >= self.threshold and overlap >= 0.5:
+                logger.info(f"Caché semántica: hit por similitud ({sims[best]:.3f})")
+                return self._meta[best][2], vec, key
+        return None, vec, key
+
+    def store(self, key: str, vec, query: str, result):
+        expira = time.time() + self.ttl
+        self._exact[key] = (expira, result)
+        while len(self._exact) > self.maxsize:
+            self._exact.popitem(last=False)
+        if vec is not None:
+            self._meta.append((self._tokens(query), expira, result))
+            fila = vec.reshape(1, -1)
+            self._matrix = (
+                fila if self._matrix is None else np.vstack([self._matrix, fila])
+            )
+            if len(self._meta) > self.maxsize:
+                self._meta = self._meta[-self.maxsize :]
+                self._matrix = self._matrix[-self.maxsize :]
+
+
+# Agrupa llamadas concurrentes a Gemini en ventanas de ~20 ms y las
+# despacha juntas con paralelismo acotado, para amortizar el coste de
+# conexión bajo ráfagas de peticiones del ESP32.
+class RequestBatcher:
+    def __init__(self, aio, model, max_batch=8, window=0.02, concurrency_limit=4):
+        self.aio = aio
+        self.model = model
+        self.max_batch = max_batch
+        self.window = window
+        self.sem = asyncio.Semaphore(concurrency_limit)
+        self.queue = asyncio.Queue()
+        self._task = None
+
+    async def submit(self, prompt, config):
+        """Encola una petición y espera su respuesta."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((prompt, config, future))
+        return await future
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # Esperar la ventana de coalescencia por si llegan más peticiones
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                restante = deadline - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), restante))
+                except asyncio.TimeoutError:
+                    break
+            async with self.sem:
+                resultados = await asyncio.gather(
+                    *[
+                        self.aio.models.generate_content(
+                            model=self.model, contents=prompt, config=config
+                        )
+                        for prompt, config, _ in batch
+                    ],
+                    return_exceptions=True,
+                )
+            for (_, _, future), resultado in zip(batch, resultados):
+                if isinstance(resultado, Exception):
+                    future.set_exception(resultado)
+                else:
+                    future.set_result(resultado)
+
+
 # Sistema de Razonamiento con Gemini
 class ReasoningSystem:
     def __init__(self, api_key, model="gemini-1.5-pro"):
@@ -59,61 +392,72 @@ class ReasoningSystem:
         self.api_key = api_key
         self.model = model
         if api_key:
-            self.client = genai.Client(api_key=api_key)
+            # Transporte compartido con keep-alive y HTTP/2: las llamadas
+            # concurrentes multiplexan sobre conexiones ya establecidas en
+            # lugar de pagar un handshake TLS cada una.
+            self.client = genai.Client(
+                api_key=api_key,
+                http_options={
+                    "async_client_args": {
+                        "http2": True,
+                        "limits": httpx.Limits(
+                            max_keepalive_connections=100, keepalive_expiry=300
+                        ),
+                    }
+                },
+            )
+            self.aio = self.client.aio
+            self.cache = SemanticCache(self.client)
+            self.batcher = RequestBatcher(self.aio, model)
         else:
             logger.warning(
                 "No se proporcionó API key para Gemini - El análisis no funcionará"
             )
             self.client = None
+            self.aio = None
+            self.cache = None
+            self.batcher = None
 
-    def generate_reasoned_response(self, query, num_cycles=3, temperature=0.7):
-        """Genera una respuesta utilizando ciclos de razonamiento."""
+    async def agenerate_reasoned_response(self, query, num_cycles=3, temperature=0.7):
+        """Genera una respuesta utilizando ciclos de razonamiento (sin bloquear el event loop)."""
         if not self.client:
             return {
                 "respuesta_final": "No se puede analizar: falta la API key de Gemini",
                 "razonamiento": [{"ciclo": 1, "análisis": "No configurado"}],
             }
 
+        # Consultar la caché antes de pagar una llamada completa a Gemini
+        vec = cache_key = None
+        if self.cache is not None:
+            cached, vec, cache_key = await self.cache.lookup(query)
+            if cached is not None:
+                return cached
+
         try:
             prompt = self._create_prompt_for_flow_analysis(query, num_cycles)
 
             generation_config = {
+                **GENERATION_CONFIG_BASE,
                 "temperature": temperature,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": 4096,
+                # Salida estructurada: Gemini garantiza un objeto JSON que
+                # cumple el esquema, sin prosa alrededor que haya que limpiar.
+                "response_mime_type": "application/json",
+                "response_schema": ANALYSIS_SCHEMA,
             }
 
-            response = self.client.models.generate_content(
-                model=self.model, contents=prompt, config=generation_config
-            )
+            response = await self.batcher.submit(prompt, generation_config)
+            result = ANALYSIS_DECODER.decode(response.text.encode())
 
-            # Procesar respuesta para extraer JSON
-            try:
-                response_text = response.text.strip()
-                json_start = response_text.find("{")
-                json_end = response_text.rfind("}") + 1
-
-                if json_start >= 0 and json_end > json_start:
-                    json_text = response_text[json_start:json_end]
-                    result = json.loads(json_text)
-
-                    # Formatear resultado para el sistema de monitoreo
-                    analisis = {
-                        "tendencia": result.get("tendencia", "desconocida"),
-                        "probabilidad_fuga": float(result.get("probabilidad_fuga", 0)),
-                        "recomendacion": result.get(
-                            "recomendacion", "No hay recomendaciones disponibles"
-                        ),
-                        "detalles": result.get("detalles", {}),
-                    }
-                    return analisis
-                else:
-                    # Fallback si no se encuentra JSON
-                    return self._create_fallback_analysis(response_text)
-            except Exception as e:
-                logger.error(f"Error al procesar respuesta JSON: {e}")
-                return self._create_fallback_analysis(response.text)
+            # Formatear resultado para el sistema de monitoreo
+            analisis = {
+                "tendencia": result.tendencia,
+                "probabilidad_fuga": result.probabilidad_fuga,
+                "recomendacion": result.recomendacion,
+                "detalles": result.detalles,
+            }
+            if self.cache is not None:
+                self.cache.store(cache_key, vec, query, analisis)
+            return analisis
 
         except Exception as e:
             logger.error(f"Error en análisis Gemini: {e}")
@@ -124,65 +468,113 @@ class ReasoningSystem:
                 "detalles": {"error": str(e)},
             }
 
-    def _create_prompt_for_flow_analysis(self, data, num_cycles=2):
-        """Crea un prompt específico para análisis de datos de flujo."""
-        return f"""
-        # Análisis de Datos de Flujo de Agua
-        
-        Analiza los siguientes datos de flujo de agua y proporciona una evaluación detallada.
-        
-        ## Datos
-        ```
-        {data}
-        ```
-        
-        ## Instrucciones
-        Realiza un análisis completo siguiendo estos pasos:
-        
-        1. Identifica patrones en los datos de flujo (estables, ascendentes, descendentes, fluctuantes)
-        2. Detecta anomalías que puedan indicar fugas o problemas
-        3. Evalúa la probabilidad de una fuga basada en los patrones
-        4. Proporciona recomendaciones específicas
-        
-        ## Formato de Respuesta
-        Tu respuesta DEBE estar en formato JSON con exactamente esta estructura:
-        
-        {{
-            "tendencia": "estable|creciente|decreciente|fluctuante",
-            "probabilidad_fuga": valor_numérico_entre_0_y_100,
-            "recomendacion": "texto con acción recomendada",
-            "detalles": {{
-                "patrones_identificados": ["lista", "de", "patrones"],
-                "anomalias": ["lista", "de", "anomalías"],
-                "explicacion": "explicación del análisis"
-            }}
-        }}
+    def generate_reasoned_response(self, query, num_cycles=3, temperature=0.7):
+        """Variante síncrona para uso fuera del servidor (scripts, demos)."""
+        return asyncio.run(
+            self.agenerate_reasoned_response(query, num_cycles, temperature)
+        )
+
+    async def stream_analysis(self, query, temperature=0.7):
+        """Transmite el análisis en texto plano según lo genera el modelo.
+
+        Una cola acotada ejerce contrapresión: si el cliente HTTP consume
+        despacio, la generación se pausa en lugar de acumular chunks en
+        memoria.
         """
+        if not self.aio:
+            yield "No se puede analizar: falta la API key de Gemini"
+            return
 
-    def _create_fallback_analysis(self, text):
-        """Crea un análisis predeterminado si falla el procesamiento de JSON."""
-        return {
-            "tendencia": "análisis incompleto",
-            "probabilidad_fuga": 0,
-            "recomendacion": "Se recomienda revisar manualmente los datos",
-            "detalles": {"respuesta_original": text[:500] + "..."},
-        }
+        prompt = self._create_prompt_for_flow_analysis(query)
+        generation_config = {**GENERATION_CONFIG_BASE, "temperature": temperature}
+
+        cola = asyncio.Queue(maxsize=8)
+        fin = object()
+
+        async def productor():
+            try:
+                stream = await self.aio.models.generate_content_stream(
+                    model=self.model, contents=prompt, config=generation_config
+                )
+                async for chunk in stream:
+                    if hasattr(chunk, "text") and chunk.text:
+                        await cola.put(chunk.text)
+            except Exception as e:
+                await cola.put(f"Error en streaming: {str(e)}")
+            finally:
+                await cola.put(fin)
+
+        tarea = asyncio.create_task(productor())
+        try:
+            while (chunk := await cola.get()) is not fin:
+                yield chunk
+        finally:
+            tarea.cancel()
+
+    def _create_prompt_for_flow_analysis(self, data, num_cycles=2):
+        """Crea un prompt específico para análisis de datos de flujo."""
+        return PROMPT_TEMPLATE % data
 
 
 # Gestor de base de datos con funcionalidades ampliadas
 class DatabaseManager:
-    def __init__(self, db_path="water_flow.db"):
+    # Las inserciones de flujo se encolan y se vuelcan por lotes: un solo
+    # fsync por lote en vez de uno por petición. El volcador espera hasta
+    # FLUSH_MAX_WAIT desde la primera fila pendiente para coalescer ráfagas.
+    FLUSH_MAX_WAIT = 0.05  # segundos
+    FLUSH_MAX_ROWS = 500
+    STATS_TTL = 10  # segundos de validez de la caché de estadísticas
+
+    def __init__(self, db_path="water_flow.db", pool_size=10):
         self.db_path = db_path
         self.initialize_db()
+        # Pool de conexiones aiosqlite de larga vida: las consultas son
+        # await-ables y el event loop ya no se bloquea con la base de
+        # datos. Se llena en startup(), cuando existe event loop.
+        self._pool = asyncio.Queue()
+        self._pool_size = pool_size
         self.pending_analysis = False
         self.records_since_last_analysis = 0
         self.analysis_threshold = 5  # Analizar cada 5 registros
-
-    def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        self._write_queue = asyncio.Queue()
+        # Caché TTL de estadísticas: (expira, versión de datos, resultado)
+        self._stats_cache = None
+        self._data_version = 0
+
+    async def _new_connection(self):
+        conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+        # WAL permite lecturas concurrentes con las escrituras; la caché
+        # grande y temp_store en memoria evitan IO en las agregaciones
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute("PRAGMA cache_size=-64000")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    async def startup(self):
+        """Llena el pool de conexiones."""
+        for _ in range(self._pool_size):
+            await self._pool.put(await self._new_connection())
+
+    async def shutdown(self):
+        """Vuelca lo pendiente y cierra las conexiones del pool."""
+        await self._flush()
+        while not self._pool.empty():
+            conn = await self._pool.get()
+            await conn.close()
+
+    @asynccontextmanager
+    async def conn(self):
+        """Presta una conexión del pool y la devuelve al terminar."""
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            await self._pool.put(conn)
 
     def initialize_db(self):
-        conn = self.get_connection()
+        conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
         # Tabla para registros de flujo
@@ -220,171 +612,293 @@ class DatabaseManager:
         )
         """)
 
-        conn.commit()
-        conn.close()
-        logger.info("Base de datos inicializada correctamente")
+        # Resumen incremental por hora, mantenido por trigger: las
+        # estadísticas se leen de aquí en O(1) en lugar de re-escanear
+        # flujo_registros en cada consulta
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            hour TEXT PRIMARY KEY,
+            sum REAL NOT NULL,
+            cnt INTEGER NOT NULL,
+            max REAL NOT NULL,
+            min REAL NOT NULL
+        )
+        """)
 
-    def guardar_flujo(self, flujo: float, analisis: str = None):
-        """Guarda un registro de flujo y controla análisis automáticos."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        timestamp = datetime.now().isoformat()
+        cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_flujo_stats AFTER INSERT ON flujo_registros
+        BEGIN
+            INSERT INTO stats_hourly(hour, sum, cnt, max, min)
+            VALUES (
+                strftime('%Y-%m-%dT%H:00', NEW.timestamp),
+                NEW.flujo, 1, NEW.flujo, NEW.flujo
+            )
+            ON CONFLICT(hour) DO UPDATE SET
+                sum = sum + NEW.flujo,
+                cnt = cnt + 1,
+                max = MAX(max, NEW.flujo),
+                min = MIN(min, NEW.flujo);
+        END
+        """)
+
+        # Rellenar el resumen a partir de los registros ya existentes
+        cursor.execute("SELECT COUNT(*) FROM stats_hourly")
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("""
+            INSERT INTO stats_hourly(hour, sum, cnt, max, min)
+            SELECT strftime('%Y-%m-%dT%H:00', timestamp),
+                   SUM(flujo), COUNT(*), MAX(flujo), MIN(flujo)
+            FROM flujo_registros
+            GROUP BY 1
+            """)
+
+        # Índice de apoyo para consultas históricas por rango de fechas.
+        # Compuesto con id para que el cursor de paginación (timestamp, id)
+        # recorra el índice sin reordenar los empates de timestamp.
+        cursor.execute("DROP INDEX IF EXISTS idx_flujo_ts")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_flujo_ts_id ON flujo_registros(timestamp DESC, id DESC)"
+        )
 
+        # Las tendencias se listan siempre ORDER BY fecha DESC
         cursor.execute(
-            "INSERT INTO flujo_registros (flujo, timestamp, analisis) VALUES (?, ?, ?)",
-            (flujo, timestamp, analisis),
+            "CREATE INDEX IF NOT EXISTS idx_tend_fecha_desc ON tendencias(fecha DESC)"
         )
+
         conn.commit()
-        id_registro = cursor.lastrowid
         conn.close()
+        logger.info("Base de datos inicializada correctamente")
+
+    async def _write_rows(self, rows):
+        """Inserta un lote de registros en una sola transacción."""
+        async with self.conn() as conn:
+            await conn.execute("BEGIN")
+            try:
+                await conn.executemany(
+                    "INSERT INTO flujo_registros (flujo, timestamp, analisis) VALUES (?, ?, ?)",
+                    rows,
+                )
+                await conn.execute("COMMIT")
+            except Exception:
+                # Sin rollback la conexión volvería al pool con la
+                # transacción abierta y todo flush posterior sobre ella
+                # fallaría con "cannot start a transaction within a
+                # transaction"
+                await conn.execute("ROLLBACK")
+                raise
+
+    async def _flush(self):
+        """Vuelca lo que haya encolado sin esperar más filas."""
+        rows = []
+        while not self._write_queue.empty():
+            rows.append(self._write_queue.get_nowait())
+        if rows:
+            await self._write_rows(rows)
+
+    async def _flusher(self):
+        """Tarea de fondo que coalesce y vuelca la cola de escrituras."""
+        loop = asyncio.get_running_loop()
+        while True:
+            rows = [await self._write_queue.get()]
+            deadline = loop.time() + self.FLUSH_MAX_WAIT
+            while len(rows) < self.FLUSH_MAX_ROWS:
+                restante = deadline - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    rows.append(
+                        await asyncio.wait_for(self._write_queue.get(), restante)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._write_rows(rows)
+            except Exception as e:
+                logger.error(f"Error al volcar la cola de flujo: {e}")
+
+    async def guardar_flujo(self, flujo: float, analisis: str = None):
+        """Encola un registro de flujo y controla análisis automáticos.
+
+        La inserción real se difiere al volcado por lotes, así que aquí
+        no existe todavía un id: AUTOINCREMENT lo asigna el executemany
+        del volcador, y con varios workers cualquier contador local
+        produciría ids duplicados que no corresponden a la fila real.
+        """
+        timestamp = _iso_now()
+
+        self._write_queue.put_nowait((flujo, timestamp, analisis))
+        self._data_version += 1
 
         # Incrementar contador para análisis automático
         self.records_since_last_analysis += 1
 
-        # Determinar si es momento de hacer análisis
+        # Determinar si es momento de hacer análisis. El contador se resetea
+        # aquí mismo para que el umbral sea O(1) y solo dispare una vez.
         if self.records_since_last_analysis >= self.analysis_threshold:
             self.pending_analysis = True
+            self.records_since_last_analysis = 0
             logger.info(
                 f"Se alcanzó umbral de {self.analysis_threshold} registros - Análisis pendiente"
             )
 
         return {
-            "id": id_registro,
             "flujo": flujo,
             "timestamp": timestamp,
             "analisis": analisis,
             "pending_analysis": self.pending_analysis,
         }
 
-    def obtener_historial(self, limite: int = 100, offset: int = 0):
-        """Obtiene el historial de registros de flujo."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute(
-            """
-            SELECT id, flujo, timestamp, analisis 
-            FROM flujo_registros 
-            ORDER BY timestamp DESC 
-            LIMIT ? OFFSET ?
-            """,
-            (limite, offset),
-        )
-
-        registros = cursor.fetchall()
-        conn.close()
-
-        return [
-            {"id": reg[0], "flujo": reg[1], "timestamp": reg[2], "analisis": reg[3]}
-            for reg in registros
-        ]
-
-    def obtener_estadisticas(self):
-        """Obtiene estadísticas calculadas de los datos de flujo."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        # Obtener estadísticas de las últimas 24 horas
-        yesterday = (datetime.now() - timedelta(days=1)).isoformat()
-
-        # Flujo promedio
-        cursor.execute(
-            "SELECT AVG(flujo) FROM flujo_registros WHERE timestamp > ?", (yesterday,)
-        )
-        flujo_promedio = cursor.fetchone()[0] or 0
-
-        # Flujo máximo
-        cursor.execute(
-            "SELECT MAX(flujo) FROM flujo_registros WHERE timestamp > ?", (yesterday,)
-        )
-        flujo_maximo = cursor.fetchone()[0] or 0
-
-        # Flujo mínimo
-        cursor.execute(
-            "SELECT MIN(flujo) FROM flujo_registros WHERE timestamp > ?", (yesterday,)
-        )
-        flujo_minimo = cursor.fetchone()[0] or 0
-
-        # Calcular eficiencia (lo simulamos como ejemplo)
-        eficiencia = 95.0 if flujo_promedio > 0 else 0
-
-        # Datos por hora (para gráficos)
-        cursor.execute(
-            """
-            SELECT 
-                strftime('%H', timestamp) as hora, 
-                AVG(flujo) as promedio_flujo,
-                COUNT(*) as total_registros
-            FROM flujo_registros 
-            WHERE timestamp > ?
-            GROUP BY hora
-            ORDER BY hora
-        """,
-            (yesterday,),
-        )
-
-        datos_por_hora = [
-            {
-                "hora": row[0],
-                "promedio_flujo": round(row[1], 2),
-                "total_registros": row[2],
-            }
-            for row in cursor.fetchall()
-        ]
-
-        # Contar total de registros
-        cursor.execute("SELECT COUNT(*) FROM flujo_registros")
-        total_registros = cursor.fetchone()[0]
-
-        # Guardar estadísticas en la tabla
-        current_timestamp = datetime.now().isoformat()
-        cursor.execute(
-            """
-            INSERT INTO estadisticas 
-            (fecha, flujo_promedio, flujo_maximo, flujo_minimo, eficiencia) 
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (current_timestamp, flujo_promedio, flujo_maximo, flujo_minimo, eficiencia),
-        )
-        conn.commit()
-
-        conn.close()
+    async def obtener_historial(
+        self,
+        limite: int = 100,
+        before: Optional[str] = None,
+        before_id: Optional[int] = None,
+    ):
+        """Obtiene el historial de registros de flujo.
+
+        Pagina por cursor compuesto: `before`/`before_id` son el timestamp
+        y el id del último registro de la página anterior, de modo que el
+        índice descendente se recorre directamente sin descartar filas como
+        haría OFFSET. El id desempata: los timestamps van a resolución de
+        segundo y cada lote volcado comparte el mismo valor, así que los
+        empates en la frontera de página son el caso normal.
+        """
+        if before is not None and before_id is None:
+            # Cursor antiguo de solo-timestamp: sin id que desempate, se
+            # corta por encima de cualquier id posible en ese timestamp
+            before_id = 2**63 - 1
+        async with self.conn() as conn:
+            async with conn.execute(
+                """
+                SELECT id, flujo, timestamp, analisis
+                FROM flujo_registros
+                WHERE (? IS NULL OR timestamp < ? OR (timestamp = ? AND id < ?))
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+                """,
+                (before, before, before, before_id, limite),
+            ) as cursor:
+                cursor.arraysize = limite
+                # Filas sqlite3.Row tal cual: indexables por nombre, sin
+                # pagar un dict por registro hasta el momento de serializar
+                return await cursor.fetchmany(limite)
+
+    async def obtener_estadisticas(self):
+        """Obtiene estadísticas de las últimas 24 horas desde el resumen horario.
+
+        El resultado se memoiza unos segundos: el sondeo en ráfaga del
+        dashboard devuelve la copia cacheada mientras no lleguen datos
+        nuevos ni caduque el TTL.
+        """
+        if self._stats_cache is not None:
+            expira, version, stats = self._stats_cache
+            if time.time() < expira and version == self._data_version:
+                return stats
+
+        hace_24h = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%dT%H:00")
+
+        async with self.conn() as conn:
+            # Agregados de la ventana y total acumulado en una sola pasada
+            # sobre el resumen horario
+            async with conn.execute(
+                """
+                SELECT
+                    SUM(CASE WHEN hour > ? THEN sum END),
+                    MAX(CASE WHEN hour > ? THEN max END),
+                    MIN(CASE WHEN hour > ? THEN min END),
+                    SUM(CASE WHEN hour > ? THEN cnt END),
+                    SUM(cnt)
+                FROM stats_hourly
+                """,
+                (hace_24h,) * 4,
+            ) as cursor:
+                suma, flujo_maximo, flujo_minimo, total_ventana, total_registros = (
+                    await cursor.fetchone()
+                )
+
+            total_ventana = total_ventana or 0
+            flujo_promedio = suma / total_ventana if total_ventana else 0
+            flujo_maximo = flujo_maximo or 0
+            flujo_minimo = flujo_minimo or 0
+            total_registros = total_registros or 0
+
+            # Calcular eficiencia (lo simulamos como ejemplo)
+            eficiencia = 95.0 if flujo_promedio > 0 else 0
+
+            # Datos por hora (para gráficos)
+            async with conn.execute(
+                """
+                SELECT hour, sum, cnt
+                FROM stats_hourly
+                WHERE hour > ?
+                ORDER BY hour
+                """,
+                (hace_24h,),
+            ) as cursor:
+                datos_por_hora = [
+                    {
+                        "hora": b[0][11:13],
+                        "promedio_flujo": round(b[1] / b[2], 2),
+                        "total_registros": b[2],
+                    }
+                    for b in await cursor.fetchall()
+                ]
 
-        return {
+        resultado = {
             "flujo_promedio": round(flujo_promedio, 2),
             "flujo_maximo": round(flujo_maximo, 2),
             "flujo_minimo": round(flujo_minimo, 2),
             "eficiencia": round(eficiencia, 2),
             "datos_por_hora": datos_por_hora,
             "total_registros": total_registros,
-            "fecha_calculo": current_timestamp,
+            "fecha_calculo": datetime.now().isoformat(),
         }
+        self._stats_cache = (
+            time.time() + self.STATS_TTL,
+            self._data_version,
+            resultado,
+        )
+        return resultado
 
-    def guardar_analisis_tendencia(self, analisis):
+    async def guardar_snapshot_estadisticas(self, stats):
+        """Persiste una instantánea de estadísticas (lo llama la tarea periódica)."""
+        async with self.conn() as conn:
+            await conn.execute(
+                """
+                INSERT INTO estadisticas
+                (fecha, flujo_promedio, flujo_maximo, flujo_minimo, eficiencia)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (
+                    stats["fecha_calculo"],
+                    stats["flujo_promedio"],
+                    stats["flujo_maximo"],
+                    stats["flujo_minimo"],
+                    stats["eficiencia"],
+                ),
+            )
+
+    async def guardar_analisis_tendencia(self, analisis):
         """Guarda un análisis de tendencia en la base de datos."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
         timestamp = datetime.now().isoformat()
 
-        cursor.execute(
-            """
-            INSERT INTO tendencias 
-            (fecha, periodo, tendencia, recomendacion, probabilidad_fuga, detalles) 
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (
-                timestamp,
-                analisis.get("periodo", "últimas 24 horas"),
-                analisis.get("tendencia", "desconocida"),
-                analisis.get("recomendacion", "No hay recomendaciones"),
-                analisis.get("probabilidad_fuga", 0.0),
-                json.dumps(analisis.get("detalles", {})),
-            ),
-        )
-
-        conn.commit()
-        id_analisis = cursor.lastrowid
-        conn.close()
+        async with self.conn() as conn:
+            cursor = await conn.execute(
+                """
+                INSERT INTO tendencias
+                (fecha, periodo, tendencia, recomendacion, probabilidad_fuga, detalles)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    timestamp,
+                    analisis.get("periodo", "últimas 24 horas"),
+                    analisis.get("tendencia", "desconocida"),
+                    analisis.get("recomendacion", "No hay recomendaciones"),
+                    analisis.get("probabilidad_fuga", 0.0),
+                    orjson.dumps(analisis.get("detalles", {})).decode(),
+                ),
+            )
+            id_analisis = cursor.lastrowid
 
         # Resetear contador de análisis
         self.records_since_last_analysis = 0
@@ -392,23 +906,19 @@ class DatabaseManager:
 
         return id_analisis
 
-    def obtener_ultimas_tendencias(self, limite: int = 5):
+    async def obtener_ultimas_tendencias(self, limite: int = 5):
         """Obtiene los análisis de tendencias más recientes."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute(
-            """
-            SELECT id, fecha, periodo, tendencia, recomendacion, probabilidad_fuga, detalles
-            FROM tendencias
-            ORDER BY fecha DESC
-            LIMIT ?
-            """,
-            (limite,),
-        )
-
-        tendencias = cursor.fetchall()
-        conn.close()
+        async with self.conn() as conn:
+            async with conn.execute(
+                """
+                SELECT id, fecha, periodo, tendencia, recomendacion, probabilidad_fuga, detalles
+                FROM tendencias
+                ORDER BY fecha DESC
+                LIMIT ?
+                """,
+                (limite,),
+            ) as cursor:
+                tendencias = await cursor.fetchall()
 
         return [
             {
@@ -418,7 +928,7 @@ class DatabaseManager:
                 "tendencia": t[3],
                 "recomendacion": t[4],
                 "probabilidad_fuga": t[5],
-                "detalles": json.loads(t[6]) if t[6] else {},
+                "detalles": orjson.loads(t[6]) if t[6] else {},
             }
             for t in tendencias
         ]
@@ -430,12 +940,22 @@ class DatabaseManager:
 
 # Inicializar componentes
 db_manager = DatabaseManager()
-reasoning_system = ReasoningSystem(GEMINI_API_KEY)
+
+
+@functools.lru_cache(maxsize=1)
+def get_reasoner() -> ReasoningSystem:
+    """Instancia única y perezosa del sistema de razonamiento.
+
+    Garantiza un solo genai.Client (y por tanto un solo transporte HTTP
+    con su pool de conexiones) por proceso.
+    """
+    return ReasoningSystem(GEMINI_API_KEY)
 
 
 # Función para analizar datos
 async def analizar_datos_flujo():
     """Analiza los datos de flujo utilizando el sistema de razonamiento."""
+    reasoning_system = get_reasoner()
     if not reasoning_system.client:
         logger.warning(
             "No se puede realizar análisis: sistema de razonamiento no inicializado"
@@ -443,49 +963,52 @@ async def analizar_datos_flujo():
         return None
 
     # Obtener los últimos registros
-    registros = db_manager.obtener_historial(limite=50)
+    registros = await db_manager.obtener_historial(limite=50)
     if len(registros) < 5:
         logger.warning("No hay suficientes datos para analizar")
         return None
 
-    # Formatear datos para el análisis
-    datos_formateados = "\n".join(
-        [
-            f"ID: {r['id']}, Flujo: {r['flujo']}%, Timestamp: {r['timestamp']}"
-            for r in registros[:50]
-        ]
-    )
-
-    # Calcular estadísticas básicas para el análisis
-    flujos = [r["flujo"] for r in registros[:50]]
-    stats = {
-        "promedio": sum(flujos) / len(flujos) if flujos else 0,
-        "maximo": max(flujos) if flujos else 0,
-        "minimo": min(flujos) if flujos else 0,
-        "total_registros": len(registros),
-    }
+    # Estadísticas básicas y registros formateados en una sola pasada
+    total = 0.0
+    maximo = minimo = registros[0]["flujo"]
+    lineas = []
+    for i, r in enumerate(registros):
+        flujo = r["flujo"]
+        total += flujo
+        if flujo > maximo:
+            maximo = flujo
+        elif flujo < minimo:
+            minimo = flujo
+        if i < 10:
+            lineas.append(
+                f"ID: {r['id']}, Flujo: {flujo}%, Timestamp: {r['timestamp']}"
+            )
+    # Los últimos 10 registros completos, no los primeros 10 caracteres
+    ultimos_10 = "\n".join(lineas)
 
     # Crear query para análisis
     query = f"""
     Análisis de datos de flujo de agua:
-    
+
     Estadísticas:
-    - Promedio: {stats["promedio"]:.2f}%
-    - Máximo: {stats["maximo"]:.2f}%
-    - Mínimo: {stats["minimo"]:.2f}%
-    - Total registros: {stats["total_registros"]}
-    
+    - Promedio: {total / len(registros):.2f}%
+    - Máximo: {maximo:.2f}%
+    - Mínimo: {minimo:.2f}%
+    - Total registros: {len(registros)}
+
     Últimos 10 registros:
-    {datos_formateados[:10]}
+    {ultimos_10}
     """
 
-    # Realizar análisis
-    resultado = reasoning_system.generate_reasoned_response(query)
+    # Realizar análisis. El resultado llega ya parseado como dict desde el
+    # sistema de razonamiento; no hay que volver a extraer JSON del texto.
+    resultado = await reasoning_system.agenerate_reasoned_response(query)
 
-    # Guardar análisis en la base de datos
-    if resultado:
+    # Guardar análisis en la base de datos (los errores no se persisten
+    # como tendencias)
+    if isinstance(resultado, dict) and resultado.get("tendencia") != "error":
         resultado["periodo"] = f"últimos {len(registros)} registros"
-        id_analisis = db_manager.guardar_analisis_tendencia(resultado)
+        id_analisis = await db_manager.guardar_analisis_tendencia(resultado)
         logger.info(f"Análisis completado y guardado con ID: {id_analisis}")
         return resultado
 
@@ -496,53 +1019,85 @@ async def analizar_datos_flujo():
 
 
 @app.post("/flujo")
-async def recibir_flujo(
-    data: FlujoAgua, request: Request, background_tasks: BackgroundTasks
-):
+async def recibir_flujo(request: Request):
     """Recibe datos de flujo desde el dispositivo ESP32."""
+    try:
+        data = FLUJO_DECODER.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
     client_host = request.client.host
     logger.info(f"Flujo recibido: {data.flujo}% desde {client_host}")
 
     # Guardar el flujo en la base de datos
-    resultado = db_manager.guardar_flujo(data.flujo)
+    resultado = await db_manager.guardar_flujo(data.flujo)
 
-    # Verificar si es momento de analizar
+    # Verificar si es momento de analizar. El flag se apaga al encolar el
+    # trabajo: antes cada POST posterior encolaba otro análisis (y otra
+    # llamada a Gemini) hasta que el primero terminara.
     if db_manager.necesita_analisis():
-        background_tasks.add_task(analizar_datos_flujo)
-        logger.info("Análisis programado en segundo plano")
+        db_manager.pending_analysis = False
+        job_id = encolar_analisis()
+        logger.info(f"Análisis encolado como trabajo {job_id}")
 
+    # Acuse de encolado: el registro aún no está insertado, de modo que
+    # no hay un id que devolver sin inventarlo
     return {
-        "mensaje": "Flujo recibido correctamente",
+        "mensaje": "Flujo encolado correctamente",
+        "estado": "encolado",
         "flujo": data.flujo,
-        "id_registro": resultado["id"],
         "timestamp": resultado["timestamp"],
     }
 
 
 @app.get("/historial")
-async def obtener_historial(limite: int = 100, offset: int = 0):
-    """Obtiene el historial de registros de flujo."""
-    registros = db_manager.obtener_historial(limite, offset)
-    return registros
+async def obtener_historial(
+    limite: int = 100,
+    before: Optional[str] = None,
+    before_id: Optional[int] = None,
+):
+    """Obtiene el historial de registros de flujo.
+
+    `before` y `before_id` aceptan el timestamp y el id del último registro
+    de la página anterior como cursor de paginación; el id desempata entre
+    registros que comparten timestamp.
+    """
+    registros = await db_manager.obtener_historial(limite, before, before_id)
+    return Response(
+        orjson.dumps([dict(r) for r in registros]), media_type="application/json"
+    )
 
 
 @app.get("/estadisticas")
 async def obtener_estadisticas():
     """Obtiene estadísticas calculadas de los datos de flujo."""
-    return db_manager.obtener_estadisticas()
+    return await db_manager.obtener_estadisticas()
 
 
 @app.get("/tendencias")
 async def obtener_tendencias(limite: int = 5):
     """Obtiene los análisis de tendencias más recientes."""
-    return db_manager.obtener_ultimas_tendencias(limite)
+    return await db_manager.obtener_ultimas_tendencias(limite)
+
+
+@app.get("/analizar-stream")
+async def analizar_stream():
+    """Transmite en streaming el análisis de los últimos registros de flujo."""
+    registros = await db_manager.obtener_historial(limite=50)
+    datos = "\n".join(
+        f"ID: {r['id']}, Flujo: {r['flujo']}%, Timestamp: {r['timestamp']}"
+        for r in registros
+    )
+    return StreamingResponse(
+        get_reasoner().stream_analysis(datos), media_type="text/event-stream"
+    )
 
 
 @app.get("/analizar-ahora")
-async def analizar_ahora(background_tasks: BackgroundTasks):
-    """Fuerza un análisis inmediato de los datos."""
-    background_tasks.add_task(analizar_datos_flujo)
-    return {"mensaje": "Análisis iniciado en segundo plano"}
+async def analizar_ahora():
+    """Encola un análisis inmediato de los datos y devuelve el id del trabajo."""
+    job_id = encolar_analisis()
+    return {"mensaje": "Análisis encolado", "job_id": job_id}
 
 
 @app.get("/")
@@ -584,10 +1139,29 @@ async def root():
 @app.get("/ultimos-datos", include_in_schema=False)
 async def ultimos_datos(limit: int = 10):
     """Obtiene los últimos datos registrados (para compatibilidad)."""
-    return db_manager.obtener_historial(limite=limit)
+    registros = await db_manager.obtener_historial(limite=limit)
+    return Response(
+        orjson.dumps([dict(r) for r in registros]), media_type="application/json"
+    )
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
+    if os.getenv("DEV"):
+        # Desarrollo: un solo worker con autoreload
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        # uvloop + httptools rinden bastante más que el loop y el parser
+        # por defecto; un worker por núcleo aprovecha todas las CPUs.
+        # Nota: con varios workers, el buffer de escrituras y los
+        # contadores de análisis son por proceso.
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=os.cpu_count(),
+            loop="uvloop",
+            http="httptools",
+            log_config=None,
+        )
@@ -1,12 +1,19 @@
 
 # Modelos de datos
-class SensorData(BaseModel):
+# SensorData usa msgspec en lugar de Pydantic: es el modelo del camino
+# caliente (una decodificación por lectura del ESP32) y el decoder
+# precompilado evita el coste de validación de BaseModel. Los modelos de
+# administración/configuración, de bajo tráfico, siguen en Pydantic.
+class SensorData(msgspec.Struct):
     device_id: str
     water_level: float
     valve_status: bool
     timestamp: Optional[str] = None
 
 
+SENSOR_DECODER = msgspec.json.Decoder(SensorData)
+
+
 class AlertData(BaseModel):
     device_id: str
     message: str
@@ -1,11 +1,97 @@
+# Índices de apoyo: las consultas del frontend filtran por device_id y
+# ordenan por timestamp DESC; sin índice SQLite ordena toda la tabla.
+# Se invoca desde los caminos de escritura con un guard de proceso: el
+# upsert de device_status necesita el índice único antes del primer
+# ON CONFLICT, y la primera llamada cubre también los de listado.
+_indexes_ready = False
+
+
+def ensure_indexes(db: sqlite3.Connection):
+    """Crea los índices de sensor_data, alerts y device_status si no existen"""
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    cursor = db.cursor()
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sensor_device_ts ON sensor_data(device_id, timestamp DESC)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_alerts_device_ts ON alerts(device_id, timestamp DESC)"
+    )
+    # Requisito del upsert ON CONFLICT(device_id) en device_status
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_device_status_id ON device_status(device_id)"
+    )
+    db.commit()
+    _indexes_ready = True
+
+
+# Configuración por dispositivo con TTL corto: el ESP32 reporta cada pocos
+# segundos y la configuración cambia rara vez, así que no hace falta un
+# SELECT por lectura. Entradas {device_id: (expira, cfg)}.
+CONFIG_TTL = 10.0
+_config_cache: dict = {}
+
+
+def _get_device_config(db: sqlite3.Connection, device_id: str):
+    """Devuelve (valve_auto_control, alert_threshold, reading_interval),
+    creando la configuración por defecto si el dispositivo es nuevo"""
+    entrada = _config_cache.get(device_id)
+    ahora = time.monotonic()
+    if entrada and entrada[0] > ahora:
+        return entrada[1]
+
+    cursor = db.cursor()
+    cursor.execute(
+        "SELECT valve_auto_control, alert_threshold, reading_interval FROM device_config WHERE device_id = ?",
+        (device_id,),
+    )
+    fila = cursor.fetchone()
+    if fila:
+        cfg = (fila[0], fila[1], fila[2])
+    else:
+        cfg = (1, 80.0, 30)
+        cursor.execute(
+            "INSERT INTO device_config (device_id, valve_auto_control, alert_threshold, reading_interval) VALUES (?, ?, ?, ?)",
+            (device_id, *cfg),
+        )
+        db.commit()
+
+    _config_cache[device_id] = (ahora + CONFIG_TTL, cfg)
+    return cfg
+
+
 # Endpoints para el ESP32
 @app.post("/api/sensor-data", response_model=dict)
 async def receive_sensor_data(
-    data: SensorData, db: sqlite3.Connection = Depends(get_db)
+    request: Request, db: sqlite3.Connection = Depends(get_db)
 ):
     """Recibe datos del sensor desde el ESP32"""
+    # Cuerpo crudo + decoder msgspec precompilado: evita el paso por
+    # Pydantic en el endpoint de mayor tráfico
+    try:
+        data = SENSOR_DECODER.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    return await process_sensor_reading(data, db)
+
+
+async def process_sensor_reading(data: SensorData, db: sqlite3.Connection):
+    """Procesa una lectura ya decodificada (endpoint y simulador)"""
+    ensure_indexes(db)
+
+    # Un solo reloj por petición: todas las filas de esta lectura comparten
+    # el mismo instante y se evita repetir datetime.now().isoformat()
+    now_iso = datetime.datetime.now().isoformat()
     if not data.timestamp:
-        data.timestamp = datetime.datetime.now().isoformat()
+        data.timestamp = now_iso
+
+    # Configuración una sola vez, antes de escribir: decide tanto la alerta
+    # como la respuesta al dispositivo
+    valve_auto_control, alert_threshold, reading_interval = _get_device_config(
+        db, data.device_id
+    )
 
     cursor = db.cursor()
     cursor.execute(
@@ -18,54 +104,32 @@ async def receive_sensor_data(
         ),
     )
 
-    # Actualizar estado del dispositivo
+    # Actualizar estado del dispositivo. Upsert en vez de INSERT OR REPLACE:
+    # REPLACE borra y reinserta la fila, perdiendo battery y
+    # firmware_version; el upsert solo toca online y last_seen
     cursor.execute(
-        "INSERT OR REPLACE INTO device_status (device_id, online, last_seen) VALUES (?, 1, ?)",
-        (data.device_id, datetime.datetime.now().isoformat()),
+        """
+        INSERT INTO device_status (device_id, online, last_seen) VALUES (?, 1, ?)
+        ON CONFLICT(device_id) DO UPDATE SET online = 1, last_seen = excluded.last_seen
+        """,
+        (data.device_id, now_iso),
     )
 
     # Verificar si supera el umbral para crear una alerta
-    cursor.execute(
-        "SELECT alert_threshold FROM device_config WHERE device_id = ?",
-        (data.device_id,),
-    )
-    config = cursor.fetchone()
-
-    if config and data.water_level > config[0]:
+    if data.water_level > alert_threshold:
         cursor.execute(
             "INSERT INTO alerts (device_id, message, level, timestamp) VALUES (?, ?, ?, ?)",
             (
                 data.device_id,
                 f"Nivel de agua crítico: {data.water_level}%",
                 3,
-                datetime.datetime.now().isoformat(),
+                now_iso,
             ),
         )
 
+    # Un único commit para lectura, estado y alerta
     db.commit()
 
-    # Obtener la configuración actual para el dispositivo
-    cursor.execute(
-        "SELECT valve_auto_control, alert_threshold, reading_interval FROM device_config WHERE device_id = ?",
-        (data.device_id,),
-    )
-    device_config = cursor.fetchone()
-
-    if not device_config:
-        # Crear configuración por defecto si no existe
-        cursor.execute(
-            "INSERT INTO device_config (device_id, valve_auto_control, alert_threshold, reading_interval) VALUES (?, ?, ?, ?)",
-            (data.device_id, 1, 80.0, 30),
-        )
-        db.commit()
-        valve_auto_control = 1
-        alert_threshold = 80.0
-        reading_interval = 30
-    else:
-        valve_auto_control = device_config[0]
-        alert_threshold = device_config[1]
-        reading_interval = device_config[2]
-
     # Retornar instrucciones al dispositivo
     return {
         "status": "success",
@@ -73,7 +137,7 @@ async def receive_sensor_data(
         if (valve_auto_control and data.water_level > alert_threshold)
         else "no_change",
         "reading_interval": reading_interval,
-        "server_time": datetime.datetime.now().isoformat(),
+        "server_time": now_iso,
     }
 
 
@@ -239,6 +303,8 @@ async def update_device_config(
         )
 
     db.commit()
+    # Que el próximo reporte del dispositivo vea la configuración nueva
+    _config_cache.pop(device_id, None)
 
     return config
 
@@ -247,45 +313,65 @@ async def update_device_config(
 @app.get("/api/simulator/generate-data")
 async def generate_simulated_data(db: sqlite3.Connection = Depends(get_db)):
     """Genera datos simulados de sensor como si vinieran del ESP32"""
-    # Obtener todos los dispositivos configurados
+    ensure_indexes(db)
+
+    # Obtener todos los dispositivos configurados con su umbral de alerta
     cursor = db.cursor()
-    cursor.execute("SELECT device_id FROM device_config")
+    cursor.execute("SELECT device_id, alert_threshold FROM device_config")
     devices = cursor.fetchall()
 
     if not devices:
-        # Si no hay dispositivos, usar uno demo
-        devices = [("ESP32_DEMO",)]
+        # Si no hay dispositivos, usar uno demo con el umbral por defecto
+        devices = [("ESP32_DEMO", 80.0)]
 
+    # Generar todas las lecturas primero y escribirlas en un solo lote:
+    # un executemany por tabla y un único commit, en vez de reentrar en
+    # la lógica del endpoint una vez por dispositivo
+    now_iso = datetime.datetime.now().isoformat()
     results = []
-
-    for device in devices:
-        device_id = device[0]
-
-        # Generar datos simulados
-        water_level = random.uniform(
-            10.0, 95.0
-        )  # Nivel de agua aleatorio entre 10% y 95%
-        valve_status = water_level > 85.0  # Cerrar válvula si nivel > 85%
-
-        # Crear entrada simulada
-        data = SensorData(
-            device_id=device_id,
-            water_level=water_level,
-            valve_status=not valve_status,  # True = abierta, False = cerrada
-            timestamp=datetime.datetime.now().isoformat(),
-        )
-
-        # Usar el endpoint existente para procesar los datos simulados
-        result = await receive_sensor_data(data, db)
+    sensor_rows = []
+    status_rows = []
+    alert_rows = []
+
+    for device_id, alert_threshold in devices:
+        # Nivel de agua aleatorio entre 10% y 95%; válvula abierta
+        # (True) salvo que el nivel supere el 85%
+        water_level = random.uniform(10.0, 95.0)
+        valve_open = water_level <= 85.0
+
+        sensor_rows.append((device_id, water_level, 1 if valve_open else 0, now_iso))
+        status_rows.append((device_id, now_iso))
+        if water_level > alert_threshold:
+            # Misma alerta de nivel 3 que generaría el endpoint real
+            alert_rows.append(
+                (device_id, f"Nivel de agua crítico: {water_level}%", 3, now_iso)
+            )
         results.append(
             {
                 "device_id": device_id,
                 "simulated_data": {
                     "water_level": water_level,
-                    "valve_status": not valve_status,
+                    "valve_status": valve_open,
                 },
-                "server_response": result,
             }
         )
 
+    cursor.executemany(
+        "INSERT INTO sensor_data (device_id, water_level, valve_status, timestamp) VALUES (?, ?, ?, ?)",
+        sensor_rows,
+    )
+    cursor.executemany(
+        """
+        INSERT INTO device_status (device_id, online, last_seen) VALUES (?, 1, ?)
+        ON CONFLICT(device_id) DO UPDATE SET online = 1, last_seen = excluded.last_seen
+        """,
+        status_rows,
+    )
+    if alert_rows:
+        cursor.executemany(
+            "INSERT INTO alerts (device_id, message, level, timestamp) VALUES (?, ?, ?, ?)",
+            alert_rows,
+        )
+    db.commit()
+
     return {"simulation_results": results}